@@ -1,4 +1,5 @@
 import numpy as np
+import pandas as pd
 import matplotlib as mpl
 mpl.use('TkAgg')
 import matplotlib.pyplot as plt
@@ -118,7 +119,253 @@ def calculate_compactness_over_time(db_connection, game_id, team_id, start_time,
     return compactness_over_time
 
 
+FORMATIONS = {
+    '4-4-2': [4, 4, 2],
+    '4-3-3': [4, 3, 3],
+    '4-2-3-1': [4, 2, 3, 1],
+    '4-1-4-1': [4, 1, 4, 1],
+    '4-5-1': [4, 5, 1],
+    '3-5-2': [3, 5, 2],
+    '3-4-3': [3, 4, 3],
+    '5-3-2': [5, 3, 2],
+    '5-4-1': [5, 4, 1],
+}
+LINE_NAMES = {3: ['D', 'M', 'F'], 4: ['D', 'DM', 'AM', 'F']}
+
+
+def standardize_shape(positions):
+    # Centre on the team centroid and scale every axis to unit spread, so the
+    # shape does not depend on pitch units or how high the block is
+    centred = positions - positions.mean(axis=-2, keepdims=True)
+    spread = centred.std(axis=-2, keepdims=True)
+    return centred / np.where(spread > 0, spread, 1)
+
+
+def formation_template(lines):
+    slots = []
+    roles = []
+    for depth, n, name in zip(np.linspace(-1, 1, len(lines)), lines, LINE_NAMES[len(lines)]):
+        width = min(1.0, 0.3 * (n - 1))
+        for i, y in enumerate(np.linspace(-width, width, n)):
+            slots.append((depth, y))
+            roles.append(f"{name}{i + 1}")
+    return standardize_shape(np.array(slots)), roles
+
+
+TEMPLATES = {name: formation_template(lines) for name, lines in FORMATIONS.items()}
+
+
+def get_team_tracking(db_connection, game_id, team_id):
+    # All frames of a team in one query instead of one query per timestamp
+    query = f"""
+    SELECT pt.frame_id, pt.timestamp, pt.period_id, pt.player_id, pt.x, pt.y, p.team_id
+    FROM player_tracking pt
+    JOIN players p ON pt.player_id = p.player_id
+    WHERE pt.game_id = '{game_id}'
+    AND p.team_id = '{team_id}'
+    ORDER BY pt.frame_id
+    """
+
+    result_df = db_connection.execute_query(query)
+
+    if result_df is None or result_df.empty:
+        print(f"No tracking data found for game_id={game_id}, team_id={team_id}")
+        return pd.DataFrame()
+
+    return result_df
+
+
+def tracking_to_arrays(tracking_df, team_id):
+    team_df = tracking_df[tracking_df['team_id'] == team_id]
+    frame_codes, frame_ids = pd.factorize(team_df['frame_id'], sort=True)
+    player_codes, player_ids = pd.factorize(team_df['player_id'])
+
+    # (frames, players, 2), NaN where a player has no position in a frame
+    positions = np.full((len(frame_ids), len(player_ids), 2), np.nan)
+    positions[frame_codes, player_codes, 0] = team_df['x'].to_numpy(dtype=float)
+    positions[frame_codes, player_codes, 1] = team_df['y'].to_numpy(dtype=float)
+
+    frames = team_df.groupby('frame_id')[['timestamp', 'period_id']].first()
+    frames = frames.reindex(frame_ids).rename_axis('frame_id').reset_index()
+
+    return positions, np.asarray(player_ids), frames
+
+
+def rolling_mean_positions(positions, periods, window, step):
+    # Mean position of every player over windows of `window` frames, taken
+    # every `step` frames. Windows never cross a period boundary.
+    valid = ~np.isnan(positions[..., 0])
+    values = np.nan_to_num(positions)
+    position_sums = np.concatenate([np.zeros((1,) + values.shape[1:]), np.cumsum(values, axis=0)])
+    frame_counts = np.concatenate([np.zeros((1, valid.shape[1])), np.cumsum(valid, axis=0)])
+
+    starts = []
+    ends = []
+    for period in pd.unique(periods):
+        period_frames = np.flatnonzero(periods == period)
+        first, last = period_frames[0], period_frames[-1] + 1
+        period_starts = np.arange(first, max(first + 1, last - window + 1), step)
+        starts.append(period_starts)
+        ends.append(np.minimum(period_starts + window, last))
+    starts = np.concatenate(starts)
+    ends = np.concatenate(ends)
+
+    counts = frame_counts[ends] - frame_counts[starts]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        means = (position_sums[ends] - position_sums[starts]) / counts[..., None]
+    presence = counts / (ends - starts)[:, None]
+
+    return means, presence, starts, ends
+
+
+def batched_assignment(cost):
+    # Hungarian assignment for a stack of square cost matrices (..., n, n).
+    # Returns the slot of every row and the total cost of each matrix.
+    from scipy.optimize import linear_sum_assignment
+
+    n = cost.shape[-1]
+    flat = cost.reshape(-1, n, n)
+    slots = np.empty(flat.shape[:2], dtype=np.int64)
+    for i, matrix in enumerate(flat):
+        _, slots[i] = linear_sum_assignment(matrix)
+    totals = np.take_along_axis(flat, slots[..., None], axis=2)[..., 0].sum(axis=1)
+
+    return slots.reshape(cost.shape[:-1]), totals.reshape(cost.shape[:-2])
+
+
+def attacking_left_by_period(positions, periods, pitch_center_x):
+    # A team spends a period mostly in its own half, so if its mean x over the
+    # period is past the centre line it defends the high-x goal and attacks left
+    with np.errstate(invalid='ignore'):
+        frame_mean_x = np.nanmean(positions[..., 0], axis=1)
+    period_mean_x = pd.Series(frame_mean_x).groupby(periods).mean()
+    return period_mean_x > pitch_center_x
+
+
+def detect_formations(tracking_df, team_id, window=300, step=60, min_presence=0.5,
+                      pitch_center_x=None):
+    # window and step are in tracking frames. Without pitch_center_x the centre
+    # line is taken halfway between the lowest and highest x in tracking_df.
+    if pitch_center_x is None and not tracking_df.empty:
+        x = tracking_df['x'].astype(float)
+        pitch_center_x = (x.min() + x.max()) / 2
+
+    positions, player_ids, frames = tracking_to_arrays(tracking_df, team_id)
+    if len(frames) == 0:
+        return pd.DataFrame()
+    if len(player_ids) < 11:
+        print(f"Only {len(player_ids)} players tracked for team_id={team_id}, no formations detected")
+        return pd.DataFrame()
+
+    periods = frames['period_id'].to_numpy()
+    means, presence, starts, ends = rolling_mean_positions(positions, periods, window, step)
+
+    # The 11 players that were on the pitch for most of each window
+    on_pitch = np.argsort(-presence, axis=1)[:, :11]
+    team_size = np.take_along_axis(presence, on_pitch, axis=1) >= min_presence
+    complete = team_size.sum(axis=1) == 11
+    lineup = np.take_along_axis(means, on_pitch[..., None], axis=1)
+
+    # Rotate every window so the team attacks towards +x, using the direction
+    # of its period, then the goalkeeper is the deepest player
+    attacks_left = attacking_left_by_period(positions, periods, pitch_center_x)
+    attacks_left = attacks_left.reindex(periods[starts]).fillna(False).to_numpy(dtype=bool)
+    lineup = lineup * np.where(attacks_left, -1, 1)[:, None, None]
+    keeper = np.argmin(np.where(np.isnan(lineup[..., 0]), np.inf, lineup[..., 0]), axis=1)
+
+    outfield_mask = np.arange(lineup.shape[1]) != keeper[:, None]
+    outfield = lineup[outfield_mask].reshape(len(lineup), -1, 2)
+    outfield_ids = player_ids[on_pitch[outfield_mask].reshape(len(lineup), -1)]
+    shapes = standardize_shape(np.nan_to_num(outfield))
+
+    names = list(TEMPLATES)
+    templates = np.stack([TEMPLATES[name][0] for name in names])
+    # Cost of every player to every slot, for every window and template
+    cost = ((shapes[:, None, :, None, :] - templates[None, :, None, :, :]) ** 2).sum(axis=-1)
+    slots, totals = batched_assignment(cost)
+
+    best = np.argmin(totals, axis=1)
+    rows = np.arange(len(best))
+    fit_error = totals[rows, best] / shapes.shape[1]
+    best_slots = slots[rows, best]
+
+    timeline = pd.DataFrame({
+        'team_id': team_id,
+        'period_id': frames['period_id'].to_numpy()[starts],
+        'start_frame': frames['frame_id'].to_numpy()[starts],
+        'end_frame': frames['frame_id'].to_numpy()[ends - 1],
+        'timestamp': frames['timestamp'].to_numpy()[starts],
+        'formation': np.where(complete, np.array(names)[best], None),
+        'fit_error': np.where(complete, fit_error, np.nan),
+    })
+    timeline['roles'] = [
+        {player: TEMPLATES[names[b]][1][slot] for player, slot in zip(ids, window_slots)} if ok else {}
+        for ids, window_slots, b, ok in zip(outfield_ids, best_slots, best, complete)
+    ]
+
+    return timeline
+
+
+def synthetic_tracking(formation, team_id='team', n_frames=600, seed=0):
+    # Tracking of one team holding `formation` on a 105 x 68 pitch, attacking
+    # +x in period 1 and -x in period 2, with some noise on every frame
+    rng = np.random.default_rng(seed)
+    lines = FORMATIONS[formation]
+    line_x = {3: [28, 45, 60], 4: [28, 40, 52, 62]}[len(lines)]
+    line_width = {1: 0, 2: 8, 3: 15, 4: 22, 5: 28}
+
+    base = [(8, 34)]
+    for x, n in zip(line_x, lines):
+        base.extend((x, y) for y in 34 + np.linspace(-line_width[n], line_width[n], n))
+    base = np.array(base, dtype=float)
+
+    rows = []
+    for frame in range(n_frames):
+        period = 1 if frame < n_frames // 2 else 2
+        xy = base + rng.normal(0, 2, base.shape)
+        if period == 2:
+            xy = np.array([105, 68]) - xy
+        for i, (x, y) in enumerate(xy):
+            rows.append({'frame_id': frame, 'timestamp': f"{frame}", 'period_id': period,
+                         'player_id': f"p{i}", 'x': x, 'y': y, 'team_id': team_id})
+    return pd.DataFrame(rows)
+
+
+def check_formation_detection():
+    # Every template, including the back-five shapes, is recognised from a
+    # clean synthetic lineup in both periods, and p0 is never given a slot
+    for formation in FORMATIONS:
+        timeline = detect_formations(synthetic_tracking(formation), 'team',
+                                     window=100, step=50, pitch_center_x=52.5)
+        detected = set(timeline['formation'])
+        assert detected == {formation}, f"{formation} detected as {detected}"
+        assert not any('p0' in roles for roles in timeline['roles']), f"{formation}: keeper got a slot"
+    print(f"All {len(FORMATIONS)} formation templates detected correctly")
+
+
+def formation_changes(timeline, min_windows=3):
+    # A formation only counts once it holds for min_windows consecutive windows.
+    # Windows without 11 players (e.g. after a red card) become 'unknown', so a
+    # lasting incomplete team ends the previous formation instead of keeping it.
+    if timeline.empty:
+        return pd.DataFrame()
+
+    formations = timeline['formation'].fillna('unknown')
+    run_id = (formations != formations.shift()).cumsum()
+    run_length = formations.groupby(run_id).transform('size')
+    stable = formations.where(run_length >= min_windows).ffill()
+
+    changed = (stable != stable.shift()) & stable.notna()
+    events = timeline.loc[changed, ['team_id', 'period_id', 'start_frame', 'timestamp']].copy()
+    events['from_formation'] = stable.shift()[changed]
+    events['to_formation'] = stable[changed]
+
+    return events.rename(columns={'start_frame': 'frame_id'}).reset_index(drop=True)
+
+
 def main():
+    check_formation_detection()
+
     db = DatabaseConnection()
 
     game_id = '5oc8drrbruovbuiriyhdyiyok'
@@ -134,6 +381,11 @@ def main():
         visualize_team_compactness(player_positions, compactness)
         plt.show()
 
+    tracking_df = get_team_tracking(db, game_id, team_id)
+    if not tracking_df.empty:
+        timeline = detect_formations(tracking_df, team_id)
+        print(formation_changes(timeline))
+
     db.close()
 
 
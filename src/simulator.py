@@ -4,6 +4,7 @@ import pandas as pd
 import numpy as np
 from matplotlib.animation import FuncAnimation
 from util import DatabaseConnection
+from formation import detect_formations, formation_changes
 import matplotlib as mpl
 mpl.use('TkAgg')
 
@@ -40,6 +41,8 @@ class MatchSimulator:
         self.trajectory_line = None
         self.max_trajectory_points = 30
         self.all_frames = []
+        self.formation_events = pd.DataFrame()
+        self.formation_text = None
         print(f"Initialized match simulator with target {frames_per_second} FPS")
 
     def load_data(self):
@@ -127,6 +130,32 @@ class MatchSimulator:
 
         return True
 
+    def load_formation_events(self, window=300, step=60):
+        if self.tracking_data is None:
+            print("No tracking data loaded. Run load_data() first.")
+            return self.formation_events
+
+        # The formation overlay is optional, the animation runs without it
+        try:
+            events = []
+            for team_id in [self.match_info['home_team_id'], self.match_info['away_team_id']]:
+                timeline = detect_formations(self.tracking_data, team_id, window=window, step=step)
+                events.append(formation_changes(timeline))
+
+            self.formation_events = pd.concat(events, ignore_index=True)
+            print(f"Detected {len(self.formation_events)} formation events")
+        except Exception as e:
+            print(f"Error detecting formations: {e}")
+            self.formation_events = pd.DataFrame()
+
+        return self.formation_events
+
+    def get_formations_at_frame(self, frame_id):
+        if self.formation_events.empty:
+            return {}
+        events = self.formation_events[self.formation_events['frame_id'] <= frame_id]
+        return events.groupby('team_id')['to_formation'].last().to_dict()
+
     def get_frame_data(self, frame_id):
         return self.tracking_data[self.tracking_data['frame_id'] == frame_id]
 
@@ -147,6 +176,7 @@ class MatchSimulator:
 
         self.time_text = self.ax.text(0, -5, "", fontsize=12, ha='center')
         self.event_text = self.ax.text(0, 73, "", fontsize=12, ha='center')
+        self.formation_text = self.ax.text(0, -9, "", fontsize=11, ha='center')
 
         home_team_id = self.match_info['home_team_id']
         away_team_id = self.match_info['away_team_id']
@@ -360,6 +390,8 @@ class MatchSimulator:
                     existing_artists.append(self.time_text)
                 if self.event_text:
                     existing_artists.append(self.event_text)
+                if self.formation_text:
+                    existing_artists.append(self.formation_text)
                 if self.trajectory_line:
                     existing_artists.append(self.trajectory_line)
                 for team_texts in self.text_objects.values():
@@ -380,6 +412,14 @@ class MatchSimulator:
                 else:
                     self.event_text.set_text("")
 
+                formations = self.get_formations_at_frame(frame['frame_id'])
+                if formations:
+                    home_team_id = self.match_info['home_team_id']
+                    away_team_id = self.match_info['away_team_id']
+                    self.formation_text.set_text(
+                        f"{self.match_info.get('home_team_name', 'Home Team')}: {formations.get(home_team_id, '?')} | "
+                        f"{self.match_info.get('away_team_name', 'Away Team')}: {formations.get(away_team_id, '?')}")
+
             for team_id in self.text_objects:
                 for text_obj in self.text_objects.get(team_id, []):
                     if text_obj in self.ax.texts:
@@ -456,7 +496,8 @@ class MatchSimulator:
                     if team_id in self.scatter_objects:
                         self.scatter_objects[team_id].set_offsets(np.zeros((0, 2)))
 
-            artists = list(self.scatter_objects.values()) + [self.time_text, self.event_text]
+            artists = list(self.scatter_objects.values()) + [self.time_text, self.event_text,
+                                                             self.formation_text]
             if self.trajectory_line:
                 artists.append(self.trajectory_line)
             artists.extend(sum(list(self.text_objects.values()), []))
@@ -508,6 +549,8 @@ if __name__ == "__main__":
 
     if simulator.load_data():
         try:
+            simulator.load_formation_events()
+
             frame_ids = sorted(simulator.tracking_data['frame_id'].unique())
             if len(frame_ids) > 0:
                 start_frame = frame_ids[0]
@@ -0,0 +1,96 @@
+import numpy as np
+import pandas as pd
+
+'''
+Helpers for working with the spadl_actions table.
+
+The database stores action_type, result and bodypart as SPADL ids (e.g. '9' for
+tackle, result '1' for success), the lists below map those ids to names.
+Coordinates are in meters on a 105 x 68 pitch.
+'''
+
+FIELD_LENGTH = 105.0
+FIELD_WIDTH = 68.0
+
+ACTION_TYPES = [
+    'pass', 'cross', 'throw_in', 'freekick_crossed', 'freekick_short',
+    'corner_crossed', 'corner_short', 'take_on', 'foul', 'tackle',
+    'interception', 'shot', 'shot_penalty', 'shot_freekick', 'keeper_save',
+    'keeper_claim', 'keeper_punch', 'keeper_pick_up', 'clearance', 'bad_touch',
+    'non_action', 'dribble', 'goalkick'
+]
+RESULTS = ['fail', 'success', 'offside', 'owngoal', 'yellow_card', 'red_card']
+BODYPARTS = ['foot', 'head', 'other', 'head/other', 'foot_left', 'foot_right']
+
+ACTION_TYPE_ID = {name: i for i, name in enumerate(ACTION_TYPES)}
+RESULT_ID = {name: i for i, name in enumerate(RESULTS)}
+BODYPART_ID = {name: i for i, name in enumerate(BODYPARTS)}
+
+SHOT_TYPES = [ACTION_TYPE_ID['shot'], ACTION_TYPE_ID['shot_freekick'], ACTION_TYPE_ID['shot_penalty']]
+# xT is an open-play model, set pieces would bias the cells they are taken from
+XT_SHOT_TYPES = [ACTION_TYPE_ID['shot']]
+MOVE_TYPES = [ACTION_TYPE_ID['pass'], ACTION_TYPE_ID['dribble'], ACTION_TYPE_ID['cross']]
+
+
+def _to_ids(values, names):
+    # Accept both the id strings stored in the database and SPADL names
+    ids = pd.to_numeric(values, errors='coerce')
+    if ids.isna().any():
+        mapping = {name: i for i, name in enumerate(names)}
+        ids = ids.fillna(values.map(mapping))
+    return ids.fillna(-1).astype(np.int64).to_numpy()
+
+
+def action_type_ids(actions):
+    return _to_ids(actions['action_type'], ACTION_TYPES)
+
+
+def result_ids(actions):
+    return _to_ids(actions['result'], RESULTS)
+
+
+def bodypart_ids(actions):
+    return _to_ids(actions['bodypart'], BODYPARTS)
+
+
+def load_spadl_actions(db_connection, game_ids=None):
+    query = """
+    SELECT a.id, a.game_id, a.period_id, a.seconds, a.player_id, a.team_id,
+           a.start_x, a.start_y, a.end_x, a.end_y,
+           a.action_type, a.result, a.bodypart,
+           m.home_team_id
+    FROM spadl_actions a
+    JOIN matches m ON a.game_id = m.match_id
+    """
+    if game_ids is not None:
+        game_list = ", ".join(f"'{game_id}'" for game_id in game_ids)
+        query += f"WHERE a.game_id IN ({game_list})\n"
+    query += "ORDER BY a.game_id, a.period_id, a.seconds, a.id"
+
+    actions = db_connection.execute_query(query)
+
+    if actions is None or actions.empty:
+        print("No SPADL actions found")
+        return pd.DataFrame()
+
+    for col in ['start_x', 'start_y', 'end_x', 'end_y', 'seconds']:
+        actions[col] = actions[col].astype(float)
+
+    print(f"Loaded {len(actions)} SPADL actions for {actions['game_id'].nunique()} games")
+    return actions
+
+
+def play_left_to_right(actions, home_team_id=None):
+    # SPADL data has the home team attacking left to right, mirror the away
+    # team's actions so every action is seen from the acting team's side.
+    actions = actions.copy()
+    if home_team_id is None:
+        home_team_id = actions['home_team_id']
+    away = (actions['team_id'] != home_team_id).to_numpy()
+
+    for col in ['start_x', 'end_x']:
+        actions.loc[away, col] = FIELD_LENGTH - actions.loc[away, col].to_numpy()
+    for col in ['start_y', 'end_y']:
+        actions.loc[away, col] = FIELD_WIDTH - actions.loc[away, col].to_numpy()
+
+    return actions
@@ -0,0 +1,358 @@
+import os
+import json
+import time
+import hashlib
+from contextlib import contextmanager
+import numpy as np
+import pandas as pd
+import sklearn
+import xgboost as xgb
+from joblib import Parallel, delayed
+from threadpoolctl import threadpool_limits
+from sklearn.preprocessing import StandardScaler, OneHotEncoder
+from sklearn.compose import ColumnTransformer
+from sklearn.pipeline import Pipeline
+from sklearn.impute import SimpleImputer
+from sklearn.cluster import KMeans, MiniBatchKMeans
+from sklearn.metrics import silhouette_score
+from sklearn.model_selection import StratifiedKFold, cross_validate
+
+'''
+Training pipeline of AI.ipynb as a module.
+
+- The preprocessed feature matrix is cached in features/cache, keyed by a hash
+  of the input columns and the preprocessing config, so it is only rebuilt
+  when the data or the config changes.
+- The k-sweep and the XGBoost cross-validation folds run in parallel.
+- With minibatch=True the CSV is only read in chunks: the cache is built chunk
+  by chunk into a memory-mapped .npy (with the preprocessor fitted on a
+  sample), the k-sweep uses MiniBatchKMeans over chunks of that matrix and the
+  XGBoost step only loads the columns it needs. The full matrix never has to
+  be in memory.
+'''
+
+TRANSITIONS_CSV = 'all_teams_transition_data.csv'
+CACHE_DIR = os.path.join('features', 'cache')
+
+NUMERICAL_FEATURES = ['loss_x', 'loss_y', 'seconds_after_loss', 'time_to_defensive_action']
+CATEGORICAL_FEATURES = [
+    'movement_direction', 'x_sector', 'y_sector',
+    'successful_defensive_action', 'defensive_success'
+]
+MODEL_FEATURES = ['loss_x', 'loss_y', 'period_id', 'loss_time', 'distance_to_goal', 'game_minute']
+TARGET = 'defensive_success'
+# Columns needed by prepare_features and the XGBoost model
+MODEL_COLUMNS = ['loss_x', 'loss_y', 'period_id', 'loss_time', TARGET]
+
+XGB_PARAMS = {
+    'learning_rate': 0.1,
+    'n_estimators': 100,
+    'max_depth': 3,
+    'min_child_weight': 1,
+    'gamma': 0,
+    'subsample': 0.8,
+    'colsample_bytree': 0.8,
+    'objective': 'binary:logistic',
+    'random_state': 42
+}
+
+
+class StageTimer:
+    def __init__(self):
+        self.timings = {}
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        yield
+        self.timings[name] = time.perf_counter() - start
+        print(f"[{name}] {self.timings[name]:.2f}s")
+
+    def report(self):
+        report = pd.DataFrame({'seconds': self.timings}).rename_axis('stage')
+        print(report.round(2))
+        return report
+
+
+def load_transitions(path=TRANSITIONS_CSV, columns=None):
+    usecols = None if columns is None else (lambda c: c in set(columns))
+    df = pd.read_csv(path, usecols=usecols)
+    print(f"Loaded {len(df)} transitions from {path}")
+    return df
+
+
+def prepare_features(df):
+    df = df.copy()
+    derived_columns = []
+
+    if 'loss_x' in df.columns and 'period_id' in df.columns:
+        df['distance_to_goal'] = np.where(
+            df['period_id'] % 2 == 1,  # Odd periods (1,3)
+            105 - df['loss_x'],         # Distance from right goal
+            df['loss_x']                # Distance from left goal
+        )
+        derived_columns.append('distance_to_goal')
+
+    if 'loss_x' in df.columns:
+        df['zone_x'] = pd.cut(
+            df['loss_x'],
+            bins=[0, 35, 70, 105],
+            labels=['Defensive', 'Middle', 'Attacking']
+        )
+        derived_columns.append('zone_x')
+
+    if 'loss_time' in df.columns:
+        df['game_minute'] = df['loss_time'] / 60
+        derived_columns.append('game_minute')
+
+    print(f"Created {len(derived_columns)} derived columns: {derived_columns}")
+    return df
+
+
+def build_preprocessor(numerical_features, categorical_features):
+    return ColumnTransformer(
+        transformers=[
+            ('num', Pipeline([("imputer", SimpleImputer(strategy="mean")),
+                              ("scaler", StandardScaler())]), numerical_features),
+            ('cat', Pipeline([("imputer", SimpleImputer(strategy="most_frequent")),
+                              ("encoder", OneHotEncoder(sparse_output=False, handle_unknown='ignore'))]),
+             categorical_features)
+        ]
+    )
+
+
+def preprocessing_config(preprocessor):
+    # Every parameter of the preprocessor (columns, imputer strategies, encoder
+    # options, ...), so editing build_preprocessor invalidates the cache
+    params = preprocessor.get_params(deep=True)
+    return {
+        'preprocessor': {name: repr(value) for name, value in params.items()},
+        'sklearn': sklearn.__version__
+    }
+
+
+def cache_key(df, config):
+    digest = hashlib.sha256()
+    digest.update(pd.util.hash_pandas_object(df, index=False).to_numpy().tobytes())
+    digest.update(json.dumps(config, sort_keys=True).encode())
+    return digest.hexdigest()[:16]
+
+
+def file_cache_key(path, config):
+    # Same as cache_key, but hashes the file in blocks instead of a DataFrame
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    digest.update(json.dumps(config, sort_keys=True).encode())
+    return digest.hexdigest()[:16]
+
+
+def cached_transform(df, numerical_features=NUMERICAL_FEATURES,
+                     categorical_features=CATEGORICAL_FEATURES, cache_dir=CACHE_DIR, mmap=False):
+    # Returns the preprocessed matrix and its column names. The matrix is
+    # stored as .npy so it can be memory-mapped for the out-of-core k-sweep.
+    columns = list(numerical_features) + list(categorical_features)
+    preprocessor = build_preprocessor(numerical_features, categorical_features)
+    key = cache_key(df[columns], preprocessing_config(preprocessor))
+    matrix_path = os.path.join(cache_dir, f"{key}.npy")
+    names_path = os.path.join(cache_dir, f"{key}.json")
+
+    if os.path.exists(matrix_path) and os.path.exists(names_path):
+        print(f"Using cached feature matrix {matrix_path}")
+        with open(names_path) as f:
+            feature_names = json.load(f)
+        return np.load(matrix_path, mmap_mode='r' if mmap else None), feature_names
+
+    X_processed = preprocessor.fit_transform(df)
+    feature_names = list(preprocessor.get_feature_names_out())
+
+    os.makedirs(cache_dir, exist_ok=True)
+    np.save(matrix_path, X_processed)
+    with open(names_path, 'w') as f:
+        json.dump(feature_names, f)
+    print(f"Cached feature matrix {X_processed.shape} to {matrix_path}")
+
+    if mmap:
+        return np.load(matrix_path, mmap_mode='r'), feature_names
+    return X_processed, feature_names
+
+
+def cached_transform_chunked(path=TRANSITIONS_CSV, numerical_features=NUMERICAL_FEATURES,
+                             categorical_features=CATEGORICAL_FEATURES, cache_dir=CACHE_DIR,
+                             chunksize=100_000, sample_rows=100_000):
+    # Out-of-core version of cached_transform, the CSV is only read chunksize
+    # rows at a time. The imputers, scaler and encoder are fitted on a random
+    # sample of sample_rows rows, categories missing from the sample are
+    # encoded as all zeros. The sample is drawn from global row numbers, so it
+    # does not depend on chunksize. Returns the memory-mapped matrix.
+    columns = list(numerical_features) + list(categorical_features)
+    preprocessor = build_preprocessor(numerical_features, categorical_features)
+    config = dict(preprocessing_config(preprocessor), sample_rows=sample_rows)
+    key = file_cache_key(path, config)
+    matrix_path = os.path.join(cache_dir, f"{key}.npy")
+    names_path = os.path.join(cache_dir, f"{key}.json")
+
+    if os.path.exists(matrix_path) and os.path.exists(names_path):
+        print(f"Using cached feature matrix {matrix_path}")
+        with open(names_path) as f:
+            feature_names = json.load(f)
+        return np.load(matrix_path, mmap_mode='r'), feature_names
+
+    n_rows = sum(len(chunk) for chunk in pd.read_csv(path, usecols=columns, chunksize=chunksize))
+    sample_index = np.random.default_rng(42).choice(n_rows, size=min(sample_rows, n_rows), replace=False)
+    sample_chunks = []
+    offset = 0
+    for chunk in pd.read_csv(path, usecols=columns, chunksize=chunksize):
+        sample_chunks.append(chunk[np.isin(np.arange(offset, offset + len(chunk)), sample_index)])
+        offset += len(chunk)
+    sample = pd.concat(sample_chunks)
+    preprocessor.fit(sample)
+    feature_names = list(preprocessor.get_feature_names_out())
+    del sample
+
+    # Written under a temporary name, so an interrupted run is never a cache hit
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = os.path.join(cache_dir, f"{key}.tmp.npy")
+    X_processed = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float64,
+                                            shape=(n_rows, len(feature_names)))
+    row = 0
+    for chunk in pd.read_csv(path, usecols=columns, chunksize=chunksize):
+        X_processed[row:row + len(chunk)] = preprocessor.transform(chunk)
+        row += len(chunk)
+    X_processed.flush()
+    del X_processed
+    os.replace(tmp_path, matrix_path)
+
+    with open(names_path, 'w') as f:
+        json.dump(feature_names, f)
+    print(f"Cached feature matrix ({n_rows}, {len(feature_names)}) to {matrix_path}")
+
+    return np.load(matrix_path, mmap_mode='r'), feature_names
+
+
+def _silhouette(X, labels, silhouette_sample):
+    # O(n^2) in the sample size, so only computed for the requested k values
+    return silhouette_score(X, labels, sample_size=min(silhouette_sample, len(X)), random_state=42)
+
+
+def _fit_kmeans(X, k, silhouette, silhouette_sample):
+    # One k per worker, KMeans itself single threaded to avoid oversubscription
+    with threadpool_limits(1):
+        kmeans = KMeans(n_clusters=k, random_state=42)
+        labels = kmeans.fit_predict(X)
+        score = _silhouette(X, labels, silhouette_sample) if silhouette else np.nan
+    return {'k': k, 'sse': kmeans.inertia_, 'silhouette': score}
+
+
+def _fit_minibatch_kmeans(X, k, batch_size, n_epochs, silhouette, silhouette_sample):
+    # Only batch_size rows of X are read at a time, X can be a memmap
+    with threadpool_limits(1):
+        kmeans = MiniBatchKMeans(n_clusters=k, batch_size=batch_size, random_state=42, n_init=3)
+        for _ in range(n_epochs):
+            for start in range(0, len(X), batch_size):
+                batch = np.asarray(X[start:start + batch_size])
+                if len(batch) >= k:
+                    kmeans.partial_fit(batch)
+
+        sse = sum(-kmeans.score(np.asarray(X[start:start + batch_size]))
+                  for start in range(0, len(X), batch_size))
+
+        score = np.nan
+        if silhouette:
+            sample = np.sort(np.random.default_rng(42).choice(
+                len(X), size=min(silhouette_sample, len(X)), replace=False))
+            sample_X = np.asarray(X[sample])
+            score = _silhouette(sample_X, kmeans.predict(sample_X), silhouette_sample)
+    return {'k': k, 'sse': sse, 'silhouette': score}
+
+
+def k_sweep(X, k_range=range(2, 11), n_jobs=-1, minibatch=False, batch_size=4096,
+            n_epochs=3, silhouette_k=None, silhouette_sample=10000):
+    # silhouette_k: the candidate k values to compute a silhouette score for,
+    # the sweep itself only needs the SSE of every k
+    silhouette_k = set(silhouette_k or [])
+    if minibatch:
+        results = Parallel(n_jobs=n_jobs)(
+            delayed(_fit_minibatch_kmeans)(X, k, batch_size, n_epochs, k in silhouette_k, silhouette_sample)
+            for k in k_range)
+    else:
+        results = Parallel(n_jobs=n_jobs)(
+            delayed(_fit_kmeans)(X, k, k in silhouette_k, silhouette_sample) for k in k_range)
+    return pd.DataFrame(results)
+
+
+def prepare_model_data(df, features=MODEL_FEATURES, target=TARGET):
+    features = [f for f in features if f in df.columns]
+    df_clean = df.dropna(subset=features + [target])
+    print(f"Data after removing NaNs: {len(df_clean)} rows (dropped {len(df) - len(df_clean)} rows)")
+
+    y = df_clean[target]
+    if y.dtype == object:
+        y = y.astype(str).str.lower().isin(['true', '1'])
+    return df_clean[features], y.astype(int)
+
+
+def xgb_cross_validate(X, y, n_splits=5, n_jobs=-1, params=None):
+    # One fold per worker, XGBoost itself single threaded to avoid oversubscription
+    model = Pipeline([
+        ('scaler', StandardScaler()),
+        ('xgb', xgb.XGBClassifier(**{**XGB_PARAMS, 'n_jobs': 1, **(params or {})}))
+    ])
+    cv = StratifiedKFold(n_splits=n_splits, shuffle=True, random_state=42)
+    scores = cross_validate(model, X, y, cv=cv, scoring=['accuracy', 'roc_auc'], n_jobs=n_jobs)
+
+    results = pd.DataFrame({
+        'accuracy': scores['test_accuracy'],
+        'roc_auc': scores['test_roc_auc'],
+        'fit_time': scores['fit_time']
+    })
+    print(f"Cross-validated accuracy: {results['accuracy'].mean():.4f} "
+          f"(+/- {results['accuracy'].std():.4f}), ROC AUC: {results['roc_auc'].mean():.4f}")
+    return results
+
+
+def run_pipeline(path=TRANSITIONS_CSV, k_range=range(2, 11), n_jobs=-1, minibatch=False,
+                 silhouette_k=None, cache_dir=CACHE_DIR, chunksize=100_000, sample_rows=100_000):
+    timer = StageTimer()
+
+    if minibatch:
+        # Out-of-core: build the matrix from CSV chunks, then only load the
+        # few columns the XGBoost model needs
+        with timer.stage('preprocess'):
+            X_processed, feature_names = cached_transform_chunked(
+                path, cache_dir=cache_dir, chunksize=chunksize, sample_rows=sample_rows)
+        with timer.stage('load'):
+            df = load_transitions(path, columns=MODEL_COLUMNS)
+        with timer.stage('prepare_features'):
+            df = prepare_features(df)
+    else:
+        with timer.stage('load'):
+            df = load_transitions(path)
+        with timer.stage('prepare_features'):
+            df = prepare_features(df)
+        with timer.stage('preprocess'):
+            X_processed, feature_names = cached_transform(df, cache_dir=cache_dir)
+    with timer.stage('k_sweep'):
+        sweep = k_sweep(X_processed, k_range, n_jobs=n_jobs, minibatch=minibatch,
+                        silhouette_k=silhouette_k)
+    print(sweep)
+
+    with timer.stage('xgb_cv'):
+        X, y = prepare_model_data(df)
+        cv_results = xgb_cross_validate(X, y, n_jobs=n_jobs)
+
+    timings = timer.report()
+
+    return {
+        'features': df,
+        'X_processed': X_processed,
+        'feature_names': feature_names,
+        'k_sweep': sweep,
+        'cv_results': cv_results,
+        'timings': timings
+    }
+
+
+if __name__ == "__main__":
+    run_pipeline()
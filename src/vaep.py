@@ -0,0 +1,317 @@
+import os
+import time
+import numpy as np
+import pandas as pd
+import xgboost as xgb
+from concurrent.futures import ProcessPoolExecutor
+from sklearn.metrics import brier_score_loss, roc_auc_score
+from util import DatabaseConnection
+from spadl import (FIELD_LENGTH, FIELD_WIDTH, ACTION_TYPES, RESULTS, BODYPARTS,
+                   SHOT_TYPES, RESULT_ID, action_type_ids, result_ids, bodypart_ids,
+                   load_spadl_actions, play_left_to_right)
+
+'''
+VAEP, see "Knowlegde Portfolio/info/VEAP.md".
+
+The game state of an action is the action itself and the previous actions in
+the same game. Actions are sorted by game and time, so "the k-th previous
+action" is just the row k positions earlier, clipped to the first row of the
+game. All features and labels are built from those shifted index arrays, no
+loop over rows or games is needed.
+
+Actions are expected to be in the left-to-right direction of play (use
+spadl.play_left_to_right). Previous actions by the opponent are mirrored so
+the whole game state is seen from the side of the team performing a0.
+'''
+
+SORT_COLUMNS = ['game_id', 'period_id', 'seconds', 'id']
+GOAL_X = FIELD_LENGTH
+GOAL_Y = FIELD_WIDTH / 2
+
+DEFAULT_PARAMS = {
+    'learning_rate': 0.1,
+    'n_estimators': 100,
+    'max_depth': 3,
+    'min_child_weight': 1,
+    'subsample': 0.8,
+    'colsample_bytree': 0.8,
+    'objective': 'binary:logistic',
+    'random_state': 42
+}
+
+
+def sort_actions(actions):
+    columns = [c for c in SORT_COLUMNS if c in actions.columns]
+    return actions.sort_values(columns, kind='stable')
+
+
+def _group_bounds(*keys):
+    # First and last row of every contiguous group, for each row
+    codes = [pd.factorize(np.asarray(k))[0] for k in keys]
+    n = len(codes[0])
+    idx = np.arange(n)
+    change = np.zeros(n, dtype=bool)
+    if n:
+        change[0] = True
+    for c in codes:
+        change[1:] |= c[1:] != c[:-1]
+
+    start = np.maximum.accumulate(np.where(change, idx, 0))
+    is_last = np.r_[change[1:], True] if n else change
+    end = np.minimum.accumulate(np.where(is_last, idx, n - 1)[::-1])[::-1]
+    return start, end
+
+
+def _onehot(ids, names, prefix):
+    valid = (ids >= 0) & (ids < len(names))
+    encoded = np.zeros((len(ids), len(names)), dtype=np.int8)
+    encoded[np.flatnonzero(valid), ids[valid]] = 1
+    return {f"{prefix}_{name}": encoded[:, i] for i, name in enumerate(names)}
+
+
+def _polar(x, y):
+    dx = GOAL_X - x
+    dy = np.abs(GOAL_Y - y)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        angle = np.nan_to_num(np.arctan(dy / dx))
+    return np.sqrt(dx ** 2 + dy ** 2), angle
+
+
+def _goals(actions):
+    # A goal is a successful shot, an own goal counts for the other team
+    types = action_type_ids(actions)
+    results = result_ids(actions)
+    goals = np.isin(types, SHOT_TYPES) & (results == RESULT_ID['success'])
+    owngoals = results == RESULT_ID['owngoal']
+    return goals, owngoals
+
+
+def compute_features(actions, nb_prev_actions=3):
+    actions = sort_actions(actions)
+    n = len(actions)
+    idx = np.arange(n)
+    game_start, _ = _group_bounds(actions['game_id'])
+
+    team = pd.factorize(actions['team_id'])[0]
+    types = action_type_ids(actions)
+    results = result_ids(actions)
+    bodyparts = bodypart_ids(actions)
+    start_x = actions['start_x'].to_numpy(dtype=float)
+    start_y = actions['start_y'].to_numpy(dtype=float)
+    end_x = actions['end_x'].to_numpy(dtype=float)
+    end_y = actions['end_y'].to_numpy(dtype=float)
+    period = actions['period_id'].to_numpy(dtype=float)
+    seconds = actions['seconds'].to_numpy(dtype=float)
+
+    features = {}
+    for k in range(nb_prev_actions):
+        prev = np.maximum(idx - k, game_start)
+        suffix = f"a{k}"
+
+        features.update(_onehot(types[prev], ACTION_TYPES, f"type_{suffix}"))
+        features.update(_onehot(results[prev], RESULTS, f"result_{suffix}"))
+        features.update(_onehot(bodyparts[prev], BODYPARTS, f"bodypart_{suffix}"))
+
+        # Mirror opponent actions to the perspective of a0's team
+        same_team = team[prev] == team
+        sx = np.where(same_team, start_x[prev], FIELD_LENGTH - start_x[prev])
+        sy = np.where(same_team, start_y[prev], FIELD_WIDTH - start_y[prev])
+        ex = np.where(same_team, end_x[prev], FIELD_LENGTH - end_x[prev])
+        ey = np.where(same_team, end_y[prev], FIELD_WIDTH - end_y[prev])
+
+        start_dist, start_angle = _polar(sx, sy)
+        end_dist, end_angle = _polar(ex, ey)
+        features.update({
+            f"start_x_{suffix}": sx, f"start_y_{suffix}": sy,
+            f"end_x_{suffix}": ex, f"end_y_{suffix}": ey,
+            f"dx_{suffix}": ex - sx, f"dy_{suffix}": ey - sy,
+            f"movement_{suffix}": np.sqrt((ex - sx) ** 2 + (ey - sy) ** 2),
+            f"start_dist_to_goal_{suffix}": start_dist,
+            f"start_angle_to_goal_{suffix}": start_angle,
+            f"end_dist_to_goal_{suffix}": end_dist,
+            f"end_angle_to_goal_{suffix}": end_angle,
+            f"period_id_{suffix}": period[prev],
+            f"time_seconds_{suffix}": seconds[prev],
+        })
+
+        if k > 0:
+            features[f"team_{suffix}"] = same_team.astype(np.int8)
+            features[f"time_delta_{k}"] = seconds - seconds[prev]
+            features[f"space_delta_{k}"] = np.sqrt((start_x - ex) ** 2 + (start_y - ey) ** 2)
+
+    if 'home_team_id' in actions.columns:
+        # Score before the action, from the point of view of a0's team
+        is_home = (actions['team_id'] == actions['home_team_id']).to_numpy()
+        goals, owngoals = _goals(actions)
+        home_goal = ((goals & is_home) | (owngoals & ~is_home)).astype(int)
+        away_goal = ((goals & ~is_home) | (owngoals & is_home)).astype(int)
+        game = actions['game_id'].to_numpy()
+        home_score = pd.Series(home_goal).groupby(game).cumsum().to_numpy() - home_goal
+        away_score = pd.Series(away_goal).groupby(game).cumsum().to_numpy() - away_goal
+
+        features['goalscore_team'] = np.where(is_home, home_score, away_score)
+        features['goalscore_opponent'] = np.where(is_home, away_score, home_score)
+        features['goalscore_diff'] = features['goalscore_team'] - features['goalscore_opponent']
+
+    return pd.DataFrame(features, index=actions.index)
+
+
+def compute_labels(actions, nr_actions=10):
+    # scores / concedes: a goal for / against the team of the action within
+    # the action itself and the next nr_actions - 1 actions of the same game
+    actions = sort_actions(actions)
+    n = len(actions)
+    idx = np.arange(n)
+    _, game_end = _group_bounds(actions['game_id'])
+
+    team = pd.factorize(actions['team_id'])[0]
+    goals, owngoals = _goals(actions)
+
+    scores = np.zeros(n, dtype=bool)
+    concedes = np.zeros(n, dtype=bool)
+    for j in range(nr_actions):
+        nxt = np.minimum(idx + j, game_end)
+        in_window = idx + j <= game_end
+        same_team = team[nxt] == team
+        scores |= in_window & ((goals[nxt] & same_team) | (owngoals[nxt] & ~same_team))
+        concedes |= in_window & ((goals[nxt] & ~same_team) | (owngoals[nxt] & same_team))
+
+    return pd.DataFrame({'scores': scores, 'concedes': concedes}, index=actions.index)
+
+
+def _fit_model(X, y, params):
+    model = xgb.XGBClassifier(**params)
+    model.fit(X, y)
+    return model
+
+
+class VAEP:
+    def __init__(self, nb_prev_actions=3, nr_actions=10, params=None, n_jobs=-1):
+        self.nb_prev_actions = nb_prev_actions
+        self.nr_actions = nr_actions
+        self.params = dict(DEFAULT_PARAMS, **(params or {}))
+        self.n_jobs = os.cpu_count() if n_jobs == -1 else n_jobs
+        self.models = {}
+        self.feature_columns = None
+
+    def compute_features(self, actions):
+        return compute_features(actions, self.nb_prev_actions)
+
+    def compute_labels(self, actions):
+        return compute_labels(actions, self.nr_actions)
+
+    def fit(self, actions, parallel=True):
+        start = time.perf_counter()
+        X = self.compute_features(actions)
+        y = self.compute_labels(actions)
+        self.feature_columns = list(X.columns)
+        print(f"Built {X.shape[1]} features for {len(X)} actions "
+              f"in {time.perf_counter() - start:.2f}s")
+
+        start = time.perf_counter()
+        if parallel and self.n_jobs > 1:
+            # Train the scoring and conceding model in separate processes,
+            # splitting the available cores between them
+            params = dict(self.params, n_jobs=max(1, self.n_jobs // 2))
+            with ProcessPoolExecutor(max_workers=2) as executor:
+                futures = {label: executor.submit(_fit_model, X, y[label], params)
+                           for label in ['scores', 'concedes']}
+                self.models = {label: f.result() for label, f in futures.items()}
+        else:
+            params = dict(self.params, n_jobs=self.n_jobs)
+            self.models = {label: _fit_model(X, y[label], params)
+                           for label in ['scores', 'concedes']}
+        print(f"Trained scores/concedes models in {time.perf_counter() - start:.2f}s")
+
+        return self
+
+    def predict(self, X):
+        X = X[self.feature_columns]
+        return pd.DataFrame({
+            label: model.predict_proba(X)[:, 1] for label, model in self.models.items()
+        }, index=X.index)
+
+    def evaluate(self, actions):
+        X = self.compute_features(actions)
+        y = self.compute_labels(actions)
+        probs = self.predict(X)
+
+        metrics = {}
+        for label in ['scores', 'concedes']:
+            metrics[label] = {
+                'brier': brier_score_loss(y[label], probs[label]),
+                'roc_auc': roc_auc_score(y[label], probs[label]) if y[label].nunique() > 1 else np.nan
+            }
+            print(f"{label:>8} | Brier: {metrics[label]['brier']:.4f} "
+                  f"| ROC AUC: {metrics[label]['roc_auc']:.4f}")
+        return metrics
+
+    def rate(self, actions):
+        # Rates every action passed in with one feature build and one
+        # predict_proba call per model
+        actions = sort_actions(actions)
+        probs = self.predict(self.compute_features(actions))
+        p_scores = probs['scores'].to_numpy()
+        p_concedes = probs['concedes'].to_numpy()
+
+        n = len(actions)
+        idx = np.arange(n)
+        period_start, _ = _group_bounds(actions['game_id'], actions['period_id'])
+        prev = np.maximum(idx - 1, period_start)
+
+        team = pd.factorize(actions['team_id'])[0]
+        same_team = team[prev] == team
+        prev_scores = np.where(same_team, p_scores[prev], p_concedes[prev])
+        prev_concedes = np.where(same_team, p_concedes[prev], p_scores[prev])
+
+        # The game state is reset at the start of a period and after a goal
+        goals, owngoals = _goals(actions)
+        reset = (prev == idx) | goals[prev] | owngoals[prev]
+        prev_scores[reset] = 0
+        prev_concedes[reset] = 0
+
+        offensive_value = p_scores - prev_scores
+        defensive_value = -(p_concedes - prev_concedes)
+
+        return pd.DataFrame({
+            'offensive_value': offensive_value,
+            'defensive_value': defensive_value,
+            'vaep_value': offensive_value + defensive_value
+        }, index=actions.index)
+
+
+def rate_game(model, db_connection, game_id):
+    actions = load_spadl_actions(db_connection, [game_id])
+    if actions.empty:
+        return actions
+    actions = play_left_to_right(actions)
+    return actions.join(model.rate(actions))
+
+
+def main():
+    db = DatabaseConnection()
+    actions = load_spadl_actions(db)
+
+    if actions.empty:
+        db.close()
+        return
+
+    actions = play_left_to_right(actions)
+
+    games = actions['game_id'].unique()
+    train_games = games[:int(len(games) * 0.8)]
+    train = actions['game_id'].isin(train_games)
+
+    model = VAEP().fit(actions[train])
+    model.evaluate(actions[~train])
+
+    start = time.perf_counter()
+    rated = rate_game(model, db, games[-1])
+    print(f"Rated {len(rated)} actions of game {games[-1]} in {time.perf_counter() - start:.2f}s")
+    print(rated.sort_values('vaep_value', ascending=False).head(10))
+
+    db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,234 @@
+import time
+import numpy as np
+import pandas as pd
+import matplotlib.pyplot as plt
+from util import DatabaseConnection
+from spadl import (FIELD_LENGTH, FIELD_WIDTH, XT_SHOT_TYPES, MOVE_TYPES, RESULT_ID,
+                   action_type_ids, result_ids, load_spadl_actions, play_left_to_right)
+
+'''
+Expected Threat (xT), see "Knowlegde Portfolio/info/Xthreat.md".
+
+Actions are expected to be in the left-to-right direction of play (use
+spadl.play_left_to_right). The pitch is cut into an l x w grid and every action
+is binned on its start and end cell, so all counts are built with np.bincount
+and rating a full season is a single array lookup.
+
+The raw counts are kept on the model, so new games can be added with update()
+without going over the older games again.
+'''
+
+
+class ExpectedThreat:
+    def __init__(self, l=16, w=12, eps=1e-5, max_iter=500, solver='iterative'):
+        self.l = l
+        self.w = w
+        self.n_cells = l * w
+        self.eps = eps
+        self.max_iter = max_iter
+        self.solver = solver
+        self.reset()
+
+    def reset(self):
+        self.shot_counts = np.zeros(self.n_cells)
+        self.goal_counts = np.zeros(self.n_cells)
+        self.move_counts = np.zeros(self.n_cells)
+        self.transition_counts = np.zeros((self.n_cells, self.n_cells))
+        self.games_seen = set()
+        self.xT = np.zeros((self.w, self.l))
+        self.n_iterations = 0
+
+    def cell_index(self, x, y):
+        # Flat index is row-major over the (w, l) surface: yi * l + xi
+        xi = np.floor(np.asarray(x, dtype=float) / FIELD_LENGTH * self.l)
+        yi = np.floor(np.asarray(y, dtype=float) / FIELD_WIDTH * self.w)
+        valid = ~(np.isnan(xi) | np.isnan(yi))
+        xi = np.clip(np.nan_to_num(xi), 0, self.l - 1).astype(np.int64)
+        yi = np.clip(np.nan_to_num(yi), 0, self.w - 1).astype(np.int64)
+        return yi * self.l + xi, valid
+
+    def _count(self, actions):
+        types = action_type_ids(actions)
+        results = result_ids(actions)
+        start, start_valid = self.cell_index(actions['start_x'], actions['start_y'])
+        end, end_valid = self.cell_index(actions['end_x'], actions['end_y'])
+
+        shots = np.isin(types, XT_SHOT_TYPES) & start_valid
+        goals = shots & (results == RESULT_ID['success'])
+        moves = np.isin(types, MOVE_TYPES) & start_valid
+        successful_moves = moves & end_valid & (results == RESULT_ID['success'])
+
+        n = self.n_cells
+        self.shot_counts += np.bincount(start[shots], minlength=n)
+        self.goal_counts += np.bincount(start[goals], minlength=n)
+        self.move_counts += np.bincount(start[moves], minlength=n)
+        pairs = start[successful_moves] * n + end[successful_moves]
+        self.transition_counts += np.bincount(pairs, minlength=n * n).reshape(n, n)
+
+    def probabilities(self):
+        total = self.shot_counts + self.move_counts
+        with np.errstate(divide='ignore', invalid='ignore'):
+            shot_prob = np.where(total > 0, self.shot_counts / total, 0.0)
+            move_prob = np.where(total > 0, self.move_counts / total, 0.0)
+            score_prob = np.where(self.shot_counts > 0, self.goal_counts / self.shot_counts, 0.0)
+            # Failed moves stay in the denominator, so they carry no value
+            transition = np.where(self.move_counts[:, None] > 0,
+                                  self.transition_counts / self.move_counts[:, None], 0.0)
+        return shot_prob, move_prob, score_prob, transition
+
+    def solve(self, warm_start=False):
+        shot_prob, move_prob, score_prob, transition = self.probabilities()
+        gain = shot_prob * score_prob
+
+        if self.solver == 'linear':
+            from scipy import sparse
+            from scipy.sparse.linalg import spsolve
+            # xT = gain + diag(move_prob) T xT  <=>  (I - diag(move_prob) T) xT = gain
+            system = sparse.identity(self.n_cells, format='csr') - \
+                sparse.diags(move_prob) @ sparse.csr_matrix(transition)
+            xT = spsolve(system.tocsc(), gain)
+            self.n_iterations = 0
+        else:
+            xT = self.xT.ravel().copy() if warm_start else np.zeros(self.n_cells)
+            self.n_iterations = 0
+            for _ in range(self.max_iter):
+                new_xT = gain + move_prob * (transition @ xT)
+                self.n_iterations += 1
+                converged = np.max(np.abs(new_xT - xT)) < self.eps
+                xT = new_xT
+                if converged:
+                    break
+
+        self.xT = np.asarray(xT).reshape(self.w, self.l)
+        return self.xT
+
+    def fit(self, actions):
+        self.reset()
+        self._count(actions)
+        if 'game_id' in actions.columns:
+            self.games_seen.update(actions['game_id'].unique())
+        self.solve()
+        print(f"Fitted xT on {len(actions)} actions "
+              f"({self.n_iterations} iterations, solver={self.solver})")
+        return self
+
+    def update(self, actions):
+        # Only count games that have not been seen yet, then re-solve from the
+        # previous surface which is already close to the new fixed point.
+        if 'game_id' in actions.columns:
+            seen = actions['game_id'].isin(self.games_seen)
+            actions = actions[~seen.to_numpy()]
+            self.games_seen.update(actions['game_id'].unique())
+
+        if actions.empty:
+            print("No new games to add")
+            return self
+
+        self._count(actions)
+        self.solve(warm_start=True)
+        print(f"Updated xT with {len(actions)} actions ({self.n_iterations} iterations)")
+        return self
+
+    def rate(self, actions):
+        # dxT of every successful pass, dribble or cross, NaN for other actions
+        types = action_type_ids(actions)
+        results = result_ids(actions)
+        start, start_valid = self.cell_index(actions['start_x'], actions['start_y'])
+        end, end_valid = self.cell_index(actions['end_x'], actions['end_y'])
+
+        rated = (np.isin(types, MOVE_TYPES) & (results == RESULT_ID['success'])
+                 & start_valid & end_valid)
+
+        surface = self.xT.ravel()
+        ratings = np.full(len(actions), np.nan)
+        ratings[rated] = surface[end[rated]] - surface[start[rated]]
+        return ratings
+
+
+def visualize_xt_surface(model):
+    plt.figure(figsize=(12, 8))
+    plt.imshow(model.xT, origin='lower', cmap='hot_r',
+               extent=[0, FIELD_LENGTH, 0, FIELD_WIDTH])
+    plt.colorbar(label='xT')
+    plt.title(f'Expected Threat ({model.l}x{model.w} grid)')
+    plt.xlabel('X Position')
+    plt.ylabel('Y Position')
+    plt.tight_layout()
+
+    return plt
+
+
+def synthetic_season(n_games=306, actions_per_game=1700, seed=42):
+    # Random actions with roughly the type mix of a season, used for benchmarks
+    rng = np.random.default_rng(seed)
+    n = n_games * actions_per_game
+    types = rng.choice([0, 21, 1, 11, 9, 10, 18], size=n,
+                       p=[0.55, 0.25, 0.03, 0.02, 0.06, 0.05, 0.04])
+    start_x = rng.uniform(0, FIELD_LENGTH, n)
+    start_y = rng.uniform(0, FIELD_WIDTH, n)
+    end_x = np.clip(start_x + rng.normal(5, 15, n), 0, FIELD_LENGTH)
+    end_y = np.clip(start_y + rng.normal(0, 10, n), 0, FIELD_WIDTH)
+    success = rng.uniform(size=n) < np.where(types == 11, 0.1, 0.8)
+
+    return pd.DataFrame({
+        'game_id': np.repeat(np.arange(n_games), actions_per_game).astype(str),
+        'action_type': types.astype(str),
+        'result': success.astype(int).astype(str),
+        'start_x': start_x, 'start_y': start_y,
+        'end_x': end_x, 'end_y': end_y
+    })
+
+
+def benchmark(actions, n_repeats=3):
+    timings = {}
+    for solver in ['iterative', 'linear']:
+        model = ExpectedThreat(solver=solver)
+
+        start = time.perf_counter()
+        for _ in range(n_repeats):
+            model.fit(actions)
+        fit_time = (time.perf_counter() - start) / n_repeats
+
+        start = time.perf_counter()
+        for _ in range(n_repeats):
+            model.rate(actions)
+        rate_time = (time.perf_counter() - start) / n_repeats
+
+        timings[solver] = (fit_time, rate_time)
+        print(f"{solver:>9} | fit: {fit_time:.3f}s ({len(actions) / fit_time:,.0f} actions/s)"
+              f" | rate: {rate_time:.3f}s ({len(actions) / rate_time:,.0f} actions/s)")
+
+    # Incremental refit: last 10% of the games added to a model fitted on the rest
+    games = actions['game_id'].unique()
+    split = actions['game_id'].isin(games[:int(len(games) * 0.9)])
+    model = ExpectedThreat().fit(actions[split])
+    start = time.perf_counter()
+    model.update(actions[~split])
+    print(f"   update | {time.perf_counter() - start:.3f}s for {(~split).sum()} new actions")
+
+    return timings
+
+
+def main():
+    db = DatabaseConnection()
+    actions = load_spadl_actions(db)
+    db.close()
+
+    if actions.empty:
+        print("Falling back to a synthetic season for the benchmark")
+        actions = synthetic_season()
+    else:
+        actions = play_left_to_right(actions)
+
+    benchmark(actions)
+
+    model = ExpectedThreat().fit(actions)
+    actions['xT_value'] = model.rate(actions)
+    print(actions.sort_values('xT_value', ascending=False).head(10))
+
+    visualize_xt_surface(model)
+    plt.show()
+
+
+if __name__ == "__main__":
+    main()